@@ -0,0 +1,487 @@
+'''
+ASGI serving mode
+
+Serves the trivia API from an event loop. The read-heavy routes (category
+and question listings, search and quizzes) run as coroutines on
+SQLAlchemy's async engine with asyncpg, so a request waiting on Postgres
+holds no thread. Every other route is passed to the regular Flask app on
+a worker thread, so both modes expose exactly the same API.
+
+This mode needs SQLAlchemy 1.4 or newer and asyncpg; install them with
+`pip install -r requirements-async.txt`. SQLite URLs run on aiosqlite
+for local testing. Run it with any ASGI server, e.g.
+
+    uvicorn --factory asgi:create_asgi_app
+'''
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from sqlalchemy import func, select
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:
+    create_async_engine = None
+
+from cache import DatabaseCounters
+from flaskr import create_app, decode_cursor, encode_cursor, listing_cache_key, QUESTIONS_PER_PAGE
+from models import engine_options, format_question, InstrumentedQueuePool, Category, QUESTION_COLUMNS
+from models import categories_with_counts_query, question_count_query
+from search import search_filter, search_rank
+from responses import COMPRESSIBLE_MIMETYPES, body_etag, encoded_etag, etag_matches
+from serializers import dumps
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    422: 'Unprocessable Entity',
+    500: 'internal server error'
+}
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type, Authorization'),
+    (b'access-control-allow-methods', b'GET, POST, PATCH, DELETE, OPTIONS')
+]
+
+
+class HTTPError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+'''
+setup_async_db(app)
+    async engine for the app's database, with the same DB_* pool
+    settings as setup_db
+'''
+
+
+def async_database_url(database_path):
+    url = make_url(database_path)
+    if url.drivername in ('postgresql', 'postgresql+psycopg2'):
+        return url.set(drivername='postgresql+asyncpg')
+    if url.drivername == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite')
+    return url
+
+
+def setup_async_db(app):
+    if create_async_engine is None:
+        raise RuntimeError('the ASGI mode needs SQLAlchemy 1.4 or newer and asyncpg; '
+                           'run pip install -r requirements-async.txt')
+    url = async_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    options = engine_options(app, url)
+    if options.get('poolclass') is InstrumentedQueuePool:
+        # async engines need an asyncio-aware pool; keep the default one
+        del options['poolclass']
+    options.pop('executemany_mode', None)
+    return create_async_engine(url, **options)
+
+
+class Request(object):
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        self.args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self._json = None
+
+    def get_json(self):
+        if self._json is None:
+            try:
+                self._json = json.loads(self.body.decode('utf-8'))
+            except ValueError:
+                raise HTTPError(400)
+        return self._json
+
+
+class Database(object):
+    '''one connection for a request, counting and timing its statements'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = 0
+        self.time = 0.0
+        self.statements = []
+
+    async def execute(self, statement):
+        started = time.perf_counter()
+        result = await self.connection.execute(statement)
+        elapsed = time.perf_counter() - started
+        self.queries += 1
+        self.time += elapsed
+        self.statements.append((elapsed, statement))
+        return result
+
+
+class AsyncTrivia(object):
+
+    def __init__(self, flask_app, engine=None):
+        self.flask_app = flask_app
+        self.engine = engine if engine is not None else setup_async_db(flask_app)
+        self.routes = [
+            ('GET', re.compile(r'^/categories$'), self.get_categories),
+            ('GET', re.compile(r'^/questions$'), self.retrieve_questions),
+            ('GET', re.compile(r'^/categories/(?P<category_id>\d+)/questions$'),
+             self.retrieve_questions_by_category_id),
+            ('POST', re.compile(r'^/questions$'), self.search_questions),
+            ('POST', re.compile(r'^/quizzes$'), self.have_a_quiz)
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+        if not self.flask_app.got_first_request:
+            # Flask runs its first-request hooks (the schema check)
+            return await self.call_flask(request, send)
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match and request.method == method:
+                return await self.handle(request, send, handler, match.groupdict())
+        await self.call_flask(request, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, request, send, handler, kwargs):
+        started = time.perf_counter()
+        headers = []
+        delegate = False
+        async with self.engine.connect() as connection:
+            database = Database(connection)
+            try:
+                result = await handler(request, database, **kwargs)
+                if result is not None:
+                    status, payload, headers = result
+            except (HTTPError, HTTPException) as error:
+                status = error.code
+                payload = {'success': False, 'error': error.code, 'message': ERROR_MESSAGES[error.code]}
+            except Exception:
+                self.flask_app.logger.exception('error in %s', handler.__name__)
+                status = 500
+                payload = {'success': False, 'error': 500, 'message': ERROR_MESSAGES[500]}
+            else:
+                delegate = result is None
+        if delegate:
+            # not something this mode handles, e.g. adding a question
+            return await self.call_flask(request, send)
+        with self.flask_app.app_context():
+            body = payload if isinstance(payload, bytes) else dumps(payload)
+        if status == 200:
+            status, body, headers = self.compress_and_validate(request, body, headers)
+        duration = time.perf_counter() - started
+        self.record(request, handler.__name__, status, duration, database)
+        headers = headers + CORS_HEADERS + [
+            (b'content-type', self.flask_app.config['JSONIFY_MIMETYPE'].encode('latin-1')),
+            (b'server-timing', 'db;dur={:.2f};desc="{} queries", app;dur={:.2f}'.format(
+                database.time * 1000, database.queries, duration * 1000).encode('latin-1'))
+        ]
+        if status == 304:
+            body = b''
+        else:
+            headers.append((b'content-length', str(len(body)).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def compress_and_validate(self, request, body, headers):
+        '''ETag, 304 and compression as in responses.init_responses'''
+        etag = dict(headers).get(b'etag')
+        etag = etag.decode('latin-1').strip('"') if etag else body_etag(body)
+        headers = [(name, value) for name, value in headers if name != b'etag']
+        if request.method == 'GET' and etag_matches(etag, parse_etags(request.headers.get('if-none-match'))):
+            return 304, b'', headers + [(b'etag', '"{}"'.format(etag).encode('latin-1'))]
+        compression = self.flask_app.extensions['compression']
+        encoding = None
+        mimetype = self.flask_app.config['JSONIFY_MIMETYPE']
+        if mimetype in COMPRESSIBLE_MIMETYPES:
+            headers = headers + [(b'vary', b'Accept-Encoding')]
+            if len(body) >= compression.min_size:
+                encoding = compression.encoding(parse_accept_header(request.headers.get('accept-encoding')))
+        if encoding is not None:
+            body = compression.compress(body, encoding)
+            headers = headers + [(b'content-encoding', encoding.encode('latin-1'))]
+        if request.method == 'GET':
+            headers = headers + [(b'etag', '"{}"'.format(encoded_etag(etag, encoding)).encode('latin-1'))]
+        return 200, body, headers
+
+    def record(self, request, endpoint, status, duration, database):
+        metrics = self.flask_app.extensions.get('metrics')
+        if metrics is None:
+            return
+        slow = [(elapsed, statement) for elapsed, statement in database.statements
+                if elapsed * 1000 >= metrics.slow_query_ms]
+        for elapsed, statement in slow:
+            self.flask_app.logger.warning('slow query (%.1f ms) in %s: %s',
+                                          elapsed * 1000, endpoint, statement)
+        metrics.record(endpoint, request.method, status, duration,
+                       database.queries, database.time, len(slow))
+
+    async def call_flask(self, request, send):
+        '''runs the request through the Flask app on a worker thread'''
+        scope = request.scope
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'CONTENT_LENGTH': str(len(request.body))
+        }
+        for name, value in request.headers.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+
+        # The response is produced on one thread from start to end, since
+        # a streamed response keeps using the connection it started with.
+        # The small queue makes that thread wait for slow clients.
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=8)
+
+        def run():
+            try:
+                iterable = self.flask_app.wsgi_app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if chunk:
+                            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+                finally:
+                    if hasattr(iterable, 'close'):
+                        iterable.close()
+            finally:
+                asyncio.run_coroutine_threadsafe(chunks.put(None), loop).result()
+
+        worker = loop.run_in_executor(None, run)
+        chunk = await chunks.get()
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': started['headers']})
+        while chunk is not None:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await chunks.get()
+        await send({'type': 'http.response.body', 'body': b''})
+        await worker
+
+    # Routes
+
+    async def load_categories(self, database):
+        categories = Category.__table__
+        result = await database.execute(
+            select(categories.c.id, categories.c.type).order_by(categories.c.type))
+        categories = {row.id: row.type for row in result}
+        if len(categories) == 0:
+            raise HTTPError(404)
+        return categories
+
+    async def paginate_questions(self, request, database, where=None):
+        selection = select(*QUESTION_COLUMNS).order_by(QUESTION_COLUMNS[0])
+        if where is not None:
+            selection = selection.where(where)
+        cursor = request.args.get('cursor', None, type=str)
+        if cursor:
+            selection = selection.where(QUESTION_COLUMNS[0] > decode_cursor(cursor))
+        else:
+            page = request.args.get('page', 1, type=int)
+            if page < 1:
+                raise HTTPError(404)
+            selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
+        result = await database.execute(selection.limit(QUESTIONS_PER_PAGE))
+        return [format_question(row) for row in result]
+
+    async def count_questions(self, database, where=None):
+        selection = select(func.count(QUESTION_COLUMNS[0]))
+        if where is not None:
+            selection = selection.where(where)
+        return (await database.execute(selection)).scalar()
+
+    async def listing_etag(self, request, database, endpoint, category_id=''):
+        '''
+        the ETag the Flask app gives the same listing (see cached), read
+        from the generation on this request's connection when it is kept
+        in the database, and in a worker thread when it is kept in Redis
+        '''
+        response_cache = self.flask_app.extensions['response_cache']
+        counters = getattr(response_cache.backend, 'counters', None)
+        if isinstance(counters, DatabaseCounters):
+            generation = (await database.execute(
+                counters.query(response_cache.generation_key()))).scalar() or 0
+        elif counters is None:
+            # the Redis client blocks, which would stall the event loop
+            generation = await asyncio.get_running_loop().run_in_executor(
+                None, response_cache.generation)
+        else:
+            generation = response_cache.generation()
+        key = listing_cache_key(self.flask_app, endpoint, category_id, request.args, generation)
+        return body_etag(key.encode())
+
+    def not_modified(self, request, etag):
+        if etag_matches(etag, parse_etags(request.headers.get('if-none-match'))):
+            return 304, b'', self.etag_header(etag)
+        return None
+
+    def etag_header(self, etag):
+        return [(b'etag', '"{}"'.format(etag).encode('latin-1'))]
+
+    def next_cursor(self, current_questions):
+        if len(current_questions) < QUESTIONS_PER_PAGE:
+            return None
+        return encode_cursor(current_questions[-1]['id'])
+
+    async def get_categories(self, request, database):
+        if request.args.get('with_counts', 0, type=int):
+            rows = (await database.execute(categories_with_counts_query())).fetchall()
+            if len(rows) == 0:
+                raise HTTPError(404)
+            return 200, {
+                'success': True,
+                'categories': {row.id: row.type for row in rows},
+                'question_counts': {row.id: row.questions for row in rows},
+                'status_code': 200
+            }, []
+        categories = await self.load_categories(database)
+        with self.flask_app.app_context():
+            body = dumps({'success': True, 'categories': categories, 'status_code': 200})
+        return 200, body, []
+
+    async def retrieve_questions(self, request, database):
+        if 'fields' in request.args:
+            return None
+        etag = await self.listing_etag(request, database, 'retrieve_questions')
+        response = self.not_modified(request, etag)
+        if response is not None:
+            return response
+        categories = await self.load_categories(database)
+        current_questions = await self.paginate_questions(request, database)
+        if len(current_questions) == 0:
+            raise HTTPError(404)
+        return 200, {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': (await database.execute(question_count_query())).scalar(),
+            'next_cursor': self.next_cursor(current_questions),
+            'categories': categories,
+            'current_category': None
+        }, self.etag_header(etag)
+
+    async def retrieve_questions_by_category_id(self, request, database, category_id):
+        if 'fields' in request.args:
+            return None
+        etag = await self.listing_etag(request, database, 'retrieve_questions_by_category_id', int(category_id))
+        response = self.not_modified(request, etag)
+        if response is not None:
+            return response
+        where = QUESTION_COLUMNS[3] == int(category_id)
+        current_questions = await self.paginate_questions(request, database, where)
+        if len(current_questions) == 0:
+            raise HTTPError(404)
+        return 200, {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': (await database.execute(question_count_query(int(category_id)))).scalar(),
+            'next_cursor': self.next_cursor(current_questions),
+        }, self.etag_header(etag)
+
+    async def search_questions(self, request, database):
+        data = request.get_json()
+        searchTerm = data.get('searchTerm', None) if isinstance(data, dict) else None
+        if (not searchTerm or database.connection.dialect.name != 'postgresql'
+                or 'fields' in request.args):
+            # adding questions, the in-process search index used on other
+            # databases and ?fields= stay with the Flask app
+            return None
+        categories = await self.load_categories(database)
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            raise HTTPError(404)
+        where = search_filter(searchTerm)
+        result = await database.execute(
+            select(*QUESTION_COLUMNS).where(where)
+            .order_by(search_rank(searchTerm).desc(), QUESTION_COLUMNS[0])
+            .offset((page - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE))
+        current_questions = [format_question(row) for row in result]
+        if len(current_questions) == 0:
+            raise HTTPError(404)
+        return 200, {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': await self.count_questions(database, where),
+            'categories': categories
+        }, []
+
+    async def have_a_quiz(self, request, database):
+        try:
+            data = request.get_json()
+            category_id = int(data['quiz_category']['id'])
+            previous_questions = [int(i) for i in data['previous_questions']]
+        except (HTTPError, KeyError, TypeError, ValueError):
+            raise HTTPError(422)
+        selection = select(*QUESTION_COLUMNS)
+        if category_id:
+            selection = selection.where(QUESTION_COLUMNS[3] == category_id)
+        if previous_questions:
+            selection = selection.where(QUESTION_COLUMNS[0].notin_(previous_questions))
+        question = (await database.execute(selection.order_by(func.random()).limit(1))).first()
+        if question is None:
+            return 200, {
+                'status_code': 200,
+                'success': True,
+                'question': None,
+                'quiz_finished': True
+            }, []
+        return 200, {
+            'status_code': 200,
+            'success': True,
+            'question': format_question(question),
+        }, []
+
+
+def create_asgi_app(test_config=None):
+    return AsyncTrivia(create_app(test_config))
@@ -0,0 +1,341 @@
+'''
+Load-testing benchmark for the trivia API.
+
+Seeds a database with generated categories and questions, then drives the
+create_app() app with concurrent test clients across every endpoint and
+reports p50/p95/p99 latency, requests per second and SQL queries per
+request for each endpoint. Results can be written to a JSON file and
+compared against an earlier run:
+
+    python benchmark.py --questions 20000 --output baseline.json
+    ... change something ...
+    python benchmark.py --questions 20000 --compare baseline.json
+
+--compare exits with status 1 when an endpoint's p95 latency or the
+overall throughput got worse by more than --tolerance.
+
+The default database is a new SQLite file. Pass --database-url to run
+against a local Postgres; existing questions there are only replaced
+when --reseed is given.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from flaskr import create_app
+from models import db, recount_questions, Question, Category
+import migrations
+
+CATEGORY_NAMES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+WORDS = ('what which who where when how many largest first famous river city painter '
+         'element planet war king team invented discovered country ocean song film').split()
+
+# rows each bulk import sends
+BULK_ROWS = 10
+
+_queries = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    _queries.count = getattr(_queries, 'count', 0) + 1
+
+
+def seed(app, num_questions, num_categories, reseed):
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        if Question.query.count() and not reseed:
+            return
+        db.session.query(Question).delete()
+        db.session.query(Category).delete()
+        for i in range(num_categories):
+            name = CATEGORY_NAMES[i % len(CATEGORY_NAMES)]
+            if i >= len(CATEGORY_NAMES):
+                name += ' ' + str(i // len(CATEGORY_NAMES) + 1)
+            db.session.add(Category(name))
+        db.session.commit()
+        category_ids = [category.id for category in Category.query.all()]
+        rng = random.Random(0)
+        rows = []
+        for i in range(num_questions):
+            rows.append({
+                'question': ' '.join(rng.choice(WORDS) for _ in range(8)) + ' #{}?'.format(i),
+                'answer': rng.choice(WORDS),
+                'category': rng.choice(category_ids),
+                'difficulty': rng.randint(1, 5)
+                })
+            if len(rows) == 1000:
+                db.session.execute(Question.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(Question.__table__.insert(), rows)
+        recount_questions(db.session.connection())
+        db.session.commit()
+
+
+class Scenario(object):
+    '''the requests one simulated client sends, in a loop'''
+
+    def __init__(self, client, category_ids, num_questions, rng):
+        self.client = client
+        self.category_ids = category_ids
+        self.pages = max(1, num_questions // 10)
+        self.rng = rng
+        self.added = []
+        self.session_id = None
+
+    def get_categories(self):
+        return self.client.get('/categories')
+
+    def retrieve_questions(self):
+        return self.client.get('/questions?page={}'.format(self.rng.randint(1, self.pages)))
+
+    def retrieve_questions_by_category_id(self):
+        return self.client.get('/categories/{}/questions'.format(self.rng.choice(self.category_ids)))
+
+    def search_questions(self):
+        return self.client.post('/questions', json={'searchTerm': self.rng.choice(WORDS)})
+
+    def have_a_quiz(self):
+        return self.client.post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'id': self.rng.choice(self.category_ids + [0])}
+            })
+
+    def get_quiz_deck(self):
+        return self.client.get('/quizzes/deck?category={}&size=20'.format(
+            self.rng.choice(self.category_ids + [0])))
+
+    def add_question(self):
+        response = self.client.post('/questions', json={
+            'question': 'Benchmark question?',
+            'answer': 'yes',
+            'category': self.rng.choice(self.category_ids),
+            'difficulty': 1
+            })
+        if response.status_code == 201:
+            self.added.append(json.loads(response.data)['question_id'])
+        return response
+
+    def delete_question(self):
+        if not self.added:
+            return self.add_question()
+        return self.client.delete('/questions/{}'.format(self.added.pop()))
+
+    def new_question(self):
+        return {
+            'question': 'Benchmark question?',
+            'answer': 'yes',
+            'category': self.rng.choice(self.category_ids),
+            'difficulty': self.rng.randint(1, 5)
+        }
+
+    def bulk_add_questions(self):
+        body = '\n'.join(json.dumps(self.new_question()) for _ in range(BULK_ROWS))
+        return self.client.post('/questions/bulk', data=body, content_type='application/x-ndjson')
+
+    def batch_questions(self):
+        operations = [{'op': 'create', 'values': self.new_question()} for _ in range(2)]
+        if self.added:
+            operations.append({'op': 'update', 'id': self.added[-1], 'values': {'difficulty': 5}})
+            operations.append({'op': 'delete', 'id': self.added.pop(0)})
+        response = self.client.post('/questions/batch', json={'operations': operations})
+        if response.status_code == 200:
+            self.added.extend(result['id'] for result in json.loads(response.data)['results']
+                              if result['status'] == 'created')
+        return response
+
+    def export_questions(self):
+        response = self.client.get('/questions/export')
+        # the export is streamed, so it only runs its query when read
+        response.get_data()
+        return response
+
+    def start_quiz_session(self):
+        response = self.client.post('/quizzes/sessions', json={
+            'quiz_category': {'id': self.rng.choice(self.category_ids + [0])}
+            })
+        if response.status_code == 201:
+            self.session_id = json.loads(response.data)['session_id']
+        return response
+
+    def next_quiz_question(self):
+        if self.session_id is None:
+            return self.start_quiz_session()
+        response = self.client.post('/quizzes/sessions/{}/next'.format(self.session_id))
+        data = json.loads(response.data)
+        self.session_id = None if response.status_code != 200 or data['quiz_finished'] else data['session_id']
+        return response
+
+    def get_metrics(self):
+        return self.client.get('/metrics')
+
+    def get_pool_stats(self):
+        return self.client.get('/stats/pool')
+
+    def steps(self):
+        return [
+            self.get_categories,
+            self.retrieve_questions,
+            self.retrieve_questions_by_category_id,
+            self.search_questions,
+            self.have_a_quiz,
+            self.get_quiz_deck,
+            self.start_quiz_session,
+            self.next_quiz_question,
+            self.retrieve_questions,
+            self.add_question,
+            self.next_quiz_question,
+            self.retrieve_questions_by_category_id,
+            self.batch_questions,
+            self.delete_question,
+            self.next_quiz_question,
+            self.bulk_add_questions,
+            self.export_questions,
+            self.get_metrics,
+            self.get_pool_stats
+        ]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run(app, num_clients, requests_per_client, num_questions, seed_value=0):
+    with app.app_context():
+        category_ids = [category.id for category in Category.query.all()]
+    samples = []
+    lock = threading.Lock()
+
+    def client_loop(index):
+        scenario = Scenario(app.test_client(), category_ids, num_questions,
+                            random.Random(seed_value + index))
+        steps = scenario.steps()
+        local = []
+        for i in range(requests_per_client):
+            step = steps[i % len(steps)]
+            _queries.count = 0
+            started = time.perf_counter()
+            response = step()
+            elapsed = time.perf_counter() - started
+            local.append((step.__name__, elapsed, _queries.count, response.status_code))
+        with lock:
+            samples.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_clients) as pool:
+        list(pool.map(client_loop, range(num_clients)))
+    duration = time.perf_counter() - started
+    return samples, duration
+
+
+def summarize(samples, duration):
+    endpoints = {}
+    for name, elapsed, queries, status in samples:
+        endpoints.setdefault(name, []).append((elapsed, queries, status))
+    report = {}
+    for name, rows in sorted(endpoints.items()):
+        latencies = [elapsed * 1000 for elapsed, _, _ in rows]
+        report[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for _, _, status in rows if status >= 500),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'queries_per_request': sum(queries for _, queries, _ in rows) / len(rows)
+        }
+    return {
+        'requests': len(samples),
+        'duration_s': duration,
+        'requests_per_second': len(samples) / duration if duration else None,
+        'endpoints': report
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''returns a list of regressions of results against baseline'''
+    regressions = []
+    if results['requests_per_second'] < baseline['requests_per_second'] * (1 - tolerance):
+        regressions.append('throughput {:.1f} req/s < baseline {:.1f} req/s'.format(
+            results['requests_per_second'], baseline['requests_per_second']))
+    for name, current in results['endpoints'].items():
+        previous = baseline['endpoints'].get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append('{} p95 {:.2f} ms > baseline {:.2f} ms'.format(
+                name, current['p95_ms'], previous['p95_ms']))
+        if current['queries_per_request'] > previous['queries_per_request'] + 0.5:
+            regressions.append('{} runs {:.1f} queries per request, baseline {:.1f}'.format(
+                name, current['queries_per_request'], previous['queries_per_request']))
+    return regressions
+
+
+def print_report(results):
+    print('{:<36} {:>8} {:>6} {:>9} {:>9} {:>9} {:>8}'.format(
+        'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for name, row in results['endpoints'].items():
+        print('{:<36} {:>8} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f}'.format(
+            name, row['requests'], row['errors'], row['p50_ms'], row['p95_ms'],
+            row['p99_ms'], row['queries_per_request']))
+    print('{} requests in {:.2f} s: {:.1f} requests/s'.format(
+        results['requests'], results['duration_s'], results['requests_per_second']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url', help='database to benchmark (default: a new SQLite file)')
+    parser.add_argument('--questions', type=int, default=10000, help='questions to seed')
+    parser.add_argument('--categories', type=int, default=6, help='categories to seed')
+    parser.add_argument('--reseed', action='store_true', help='replace existing questions and categories')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before --compare fails (default 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+    seed(app, args.questions, args.categories, args.reseed or args.database_url is None)
+    samples, duration = run(app, args.clients, args.requests, args.questions)
+    results = summarize(samples, duration)
+    with app.app_context():
+        dialect = db.engine.dialect.name
+    results['config'] = {
+        'database': dialect,
+        'questions': args.questions,
+        'categories': args.categories,
+        'clients': args.clients,
+        'requests_per_client': args.requests
+    }
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
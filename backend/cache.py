@@ -0,0 +1,243 @@
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, exc, select
+
+from models import db, CacheCounter, Category
+from serializers import dumps
+
+'''
+CategoryCache
+    an app's copy of the categories table, kept in
+    app.extensions['category_cache']. It also keeps the
+    serialized GET /categories response body and its ETag so the
+    endpoint doesn't re-encode anything until the categories change.
+    Entries are rebuilt when the TTL runs out (writes made by other
+    processes) or when the version is bumped by a write in this one.
+'''
+
+CachedCategories = collections.namedtuple(
+    'CachedCategories', ['categories', 'body', 'etag', 'version', 'loaded_at'])
+
+
+class CategoryCache:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.version = 0
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        entry = self._entry
+        if (entry is not None and entry.version == self.version
+                and time.monotonic() - entry.loaded_at < self.ttl):
+            return entry
+        with self._lock:
+            version = self.version
+            categories = {}
+            for category in Category.query.order_by(Category.type).all():
+                categories[category.id] = category.type
+            body = dumps({
+                'success': True,
+                'categories': categories,
+                'status_code': 200
+                })
+            etag = hashlib.sha1(body).hexdigest()
+            self._entry = CachedCategories(categories, body, etag, version, time.monotonic())
+            return self._entry
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def invalidate_categories(mapper, connection, target):
+    category_cache = current_app.extensions.get('category_cache') if has_app_context() else None
+    if category_cache is not None:
+        category_cache.invalidate()
+
+'''
+ResponseCache
+    serialized response bodies of read endpoints, keyed by endpoint,
+    category, page and cursor. Every key also carries a generation
+    number that writes bump, so pages cached before a question was added
+    or deleted are never served again; they simply age out after the
+    TTL.
+
+    The storage is pluggable: LRUBackend keeps entries in this process
+    and the generation in the cache_counters table, so a write in one
+    worker invalidates the pages cached by all of them. RedisBackend
+    shares both between processes through any client with redis-py's
+    get/set/incr. A generation kept outside the database can be newer
+    than a lagging replica, so pages read from a replica are then not
+    cached.
+'''
+
+
+class LocalCounters:
+    '''counters kept in this process, for a single worker or tests'''
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class DatabaseCounters:
+    '''
+    counters kept in the app's database, shared by every worker. They
+    are read through the request's session, so a request on a replica
+    reads the generation that matches the pages it reads there; they
+    are always bumped on the primary.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def query(key):
+        '''the select of a counter's value, also run by the ASGI app'''
+        counters = CacheCounter.__table__
+        return select([counters.c.value]).where(counters.c.name == key)
+
+    def get(self, key):
+        return db.session.execute(self.query(key)).scalar() or 0
+
+    def incr(self, key):
+        counters = CacheCounter.__table__
+        try:
+            return self._incr(counters, key)
+        except exc.IntegrityError:
+            # another worker created the counter first
+            return self._incr(counters, key)
+
+    def _incr(self, counters, key):
+        with db.get_engine(self.app).begin() as connection:
+            result = connection.execute(
+                counters.update().where(counters.c.name == key)
+                .values(value=counters.c.value + 1))
+            if result.rowcount == 0:
+                connection.execute(counters.insert().values(name=key, value=1))
+            return connection.execute(self.query(key)).scalar()
+
+
+class LRUBackend:
+
+    def __init__(self, maxsize=1024, counters=None):
+        self.maxsize = maxsize
+        self.counters = counters if counters is not None else LocalCounters()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def counter(self, key):
+        return self.counters.get(key)
+
+    def incr(self, key):
+        return self.counters.incr(key)
+
+
+class RedisBackend:
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl)
+
+    def counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+class ResponseCache:
+
+    def __init__(self, backend=None, ttl=300, prefix='trivia:'):
+        self.backend = backend if backend is not None else LRUBackend()
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_config(cls, config, counters=None):
+        '''
+        RESPONSE_CACHE_URL      redis:// URL of a shared cache (default: in process)
+        RESPONSE_CACHE_SIZE     entries kept by the in-process cache (default 1024)
+        RESPONSE_CACHE_TTL      seconds an entry lives (default 300)
+
+        counters keeps the generation of the in-process cache (default:
+        in this process only, which is right for a single worker)
+        '''
+        def setting(name, default):
+            return config.get(name, os.environ.get(name, default))
+        url = setting('RESPONSE_CACHE_URL', None)
+        if url:
+            import redis
+            backend = RedisBackend(redis.Redis.from_url(url))
+        else:
+            backend = LRUBackend(int(setting('RESPONSE_CACHE_SIZE', 1024)), counters)
+        return cls(backend, int(setting('RESPONSE_CACHE_TTL', 300)))
+
+    def generation_matches_reads(self):
+        '''whether the generation is read from the database the pages come from'''
+        return isinstance(getattr(self.backend, 'counters', None), DatabaseCounters)
+
+    def generation_key(self):
+        return self.prefix + 'generation'
+
+    def generation(self):
+        return self.backend.counter(self.generation_key())
+
+    def key(self, *parts, generation=None):
+        if generation is None:
+            generation = self.generation()
+        return '{}response:{}:{}'.format(
+            self.prefix, generation, ':'.join(str(part) for part in parts))
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, body):
+        self.backend.set(key, body, self.ttl)
+
+    def bump(self):
+        return self.backend.incr(self.generation_key())
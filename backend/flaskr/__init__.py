@@ -1,43 +1,244 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random, operator
-from models import setup_db, Question, Category
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+import base64, binascii, collections, functools, json, operator
+from models import setup_db, pool_status, db, db_setting, format_question, read_from_replica, Question, QUESTION_COLUMNS
+from models import adjust_question_counts, categories_with_counts_query, count_questions, write_questions
+from serializers import jsonify
+from cache import CategoryCache, DatabaseCounters, ResponseCache
+from metrics import init_metrics
+from migrations import cli as migrations_cli, init_schema_check
+from question_pool import QuestionPool
+from quiz_sessions import quiz_session_store
+from replicas import read_only
+from responses import body_etag, init_responses, not_modified
+from search import TrigramIndex, search_questions
 
 QUESTIONS_PER_PAGE = 10
+BULK_BATCH_SIZE = 1000
+BATCH_MAX_OPERATIONS = 1000
+DECK_SIZE = 10
+DECK_MAX_SIZE = 50
+EXPORT_BATCH_SIZE = 1000
+
+
+def validate_question(data, partial=False, categories=None):
+    '''
+    returns the column values for a new question and None, or None and
+    the reason the question was rejected. With partial=True only the
+    fields present in data are checked and returned, for updates. Given
+    categories (the known category ids), an unknown category is
+    rejected too, so it doesn't fail a whole batch in the database.
+    '''
+    fields = ('question', 'answer', 'category', 'difficulty')
+    if partial:
+        fields = [field for field in fields if field in data]
+        if not fields:
+            return None, 'nothing to update'
+    missing = [field for field in fields if not data.get(field)]
+    if missing:
+        return None, 'missing ' + ', '.join(missing)
+    values = {}
+    try:
+        for field in fields:
+            convert = int if field in ('category', 'difficulty') else str
+            values[field] = convert(data[field])
+    except (TypeError, ValueError):
+        return None, 'category and difficulty must be integers'
+    if categories is not None and 'category' in values and values['category'] not in categories:
+        return None, 'unknown category {}'.format(values['category'])
+    return values, None
+
+
+# Parts of a listing a client can ask for with ?fields=; the question id
+# is always sent.
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+LISTING_FIELDS = QUESTION_FIELDS + ('categories',)
+
+
+def requested_fields(request):
+    fields = request.args.get('fields', None, type=str)
+    if fields is None:
+        return LISTING_FIELDS
+    fields = {field.strip() for field in fields.split(',') if field.strip()}
+    if not fields <= set(LISTING_FIELDS):
+        abort(400)
+    return fields | {'id'}
+
+
+# Bulk import readers yield a dict for each row, or the reason the row
+# couldn't be read.
+def ndjson_rows(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line.decode('utf-8'))
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else 'not a JSON object'
+
+
+def csv_rows(stream):
+    # only bulk imports need csv, so workers don't load it at startup
+    import csv
+    invalid_lines = set()
+
+    def lines():
+        for line_number, line in enumerate(stream, 1):
+            try:
+                yield line.decode('utf-8')
+            except UnicodeDecodeError:
+                invalid_lines.add(line_number)
+                yield line.decode('utf-8', 'replace')
+
+    reader = csv.DictReader(lines())
+    last_line = 1
+    for row in reader:
+        # a quoted field can span several lines
+        first_line, last_line = last_line + 1, reader.line_num
+        if invalid_lines.intersection(range(first_line, last_line + 1)):
+            yield 'not valid UTF-8'
+        else:
+            yield row
+
+
+def listing_cache_key(app, endpoint, category_id, args, generation=None):
+    '''
+    the response cache key of a question listing, which also makes its
+    ETag; shared with the ASGI app so both give a page the same ETag
+    '''
+    return app.extensions['response_cache'].key(
+        endpoint,
+        category_id,
+        args.get('page', '1'),
+        args.get('cursor', ''),
+        args.get('fields', ''),
+        app.extensions['category_cache'].version,
+        generation=generation
+        )
+
+
+# Opaque keyset cursors: the id of the last question on the previous page.
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError, binascii.Error):
+        abort(400)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    # UTF-8 output lets serializers.jsonify use orjson when it is installed
+    app.config['JSON_AS_ASCII'] = False
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
     CORS(app)
+    init_metrics(app)
+    init_responses(app)
+    app.cli.add_command(migrations_cli)
+    init_schema_check(app)
+    response_cache = app.extensions['response_cache'] = ResponseCache.from_config(
+        app.config, DatabaseCounters(app))
+    quiz_sessions = app.extensions['quiz_sessions'] = quiz_session_store(app.config)
+    # per app, so apps on different databases in one process don't share them
+    category_cache = app.extensions['category_cache'] = CategoryCache()
+    question_pool = app.extensions['question_pool'] = QuestionPool(
+        replica_ttl=db_setting(app, 'DB_READ_AFTER_WRITE_SECONDS', 5, float))
+    search_index = app.extensions['search_index'] = TrigramIndex()
+
+
+    def questions_changed():
+        question_pool.invalidate()
+        response_cache.bump()
+
+
+    def cached(view):
+        '''
+        serves a GET view from response_cache, keyed by endpoint, category,
+        page, cursor and fields; only successful responses are stored.
+        The key carries the data generation, so it also makes the ETag and
+        an unchanged page is answered with 304 without running the view.
+        '''
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            key = listing_cache_key(app, request.endpoint, kwargs.get('category_id', ''), request.args)
+            etag = body_etag(key.encode())
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            body = response_cache.get(key)
+            current = True
+            if body is not None:
+                response = Response(body, mimetype=app.config['JSONIFY_MIMETYPE'])
+            else:
+                response = make_response(view(**kwargs))
+                # a replica may not have caught up with a generation kept
+                # elsewhere, so its page doesn't belong under that key
+                current = response_cache.generation_matches_reads() or not db.session().used_replica
+                if response.status_code == 200 and current:
+                    response_cache.set(key, response.get_data())
+            if response.status_code == 200 and current:
+                response.set_etag(etag)
+            return response
+        return wrapper
+
+    def paginate_questions(request, selection, fields=QUESTION_FIELDS):
+        cursor = request.args.get('cursor', None, type=str)
+        selection = selection.order_by(Question.id)
+        if cursor:
+            selection = selection.filter(Question.id > decode_cursor(cursor))
+        else:
+            page = request.args.get('page', 1, type=int)
+            if page < 1:
+                abort(404)
+            selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
+        columns = [column for column in QUESTION_COLUMNS if column.key in fields]
+        selection = selection.with_entities(*columns).limit(QUESTIONS_PER_PAGE).all()
+        current_questions = [format_question(row) for row in selection]
+        return current_questions
 
-    Question_Per_Page = 10
 
+    def next_cursor(current_questions):
+        if len(current_questions) < QUESTIONS_PER_PAGE:
+            return None
+        return encode_cursor(current_questions[-1]['id'])
 
-    def paginate_questions(request, selection):
-        page = request.args.get('page', 1, type=int)
-        start = (page - 1) * Question_Per_Page
-        end = start + QUESTIONS_PER_PAGE
-        if start > len(selection):
-            abort(404)
-        questions = [question.format() for question in selection]
-        current_questions = questions[start:end]
-        return current_questions
 
         # This method id added to sort list od categories
 
 
-    def format_categories(categories):
+    def format_categories():
+        categories = category_cache.get().categories
         if len(categories) == 0:
             abort(404)
-        format_categories = {}
-        index = 0
-        for index in range(len(categories)):
-            format_categories[categories[index].id] = categories[index].type
-        return format_categories
+        return categories
+
+
+    def known_categories(data):
+        '''
+        the cached category ids, reloaded first if they don't include
+        data's category, which another worker may have just added
+        '''
+        categories = category_cache.get().categories
+        try:
+            category_id = int(data.get('category'))
+        except (TypeError, ValueError):
+            return categories
+        if category_id not in categories:
+            category_cache.invalidate()
+            categories = category_cache.get().categories
+        return categories
 
 
     @app.after_request
@@ -55,38 +256,57 @@ def create_app(test_config=None):
 
     @app.route('/categories', methods=['GET'])
     def get_categories():
+        if request.args.get('with_counts', 0, type=int):
+            return get_categories_with_counts()
         try:
-            categories = Category.query.order_by(Category.type).all()
-            if len(categories) == 0:
-                abort(404)
+            categories = category_cache.get()
+        except:
+            abort(422)
+        if len(categories.categories) == 0:
+            abort(404)
+        response = Response(categories.body, mimetype='application/json')
+        response.set_etag(categories.etag)
+        return response
+
+
+    def get_categories_with_counts():
+        try:
+            rows = db.session.execute(categories_with_counts_query()).fetchall()
         except:
             abort(422)
-        return(jsonify({
+        if len(rows) == 0:
+            abort(404)
+        return jsonify({
             'success': True,
-            'categories': format_categories(categories),
+            'categories': {row.id: row.type for row in rows},
+            'question_counts': {row.id: row.questions for row in rows},
             'status_code': 200
-            })), 200
+            })
 
 
     @app.route('/questions', methods=['GET'])
+    @cached
     def retrieve_questions():
-        try:
-            categories = Category.query.order_by(Category.type).all()
+        fields = requested_fields(request)
+        payload = {'success': True}
+        if 'categories' in fields:
+            try:
+                categories = category_cache.get().categories
+            except:
+                abort(422)
             if len(categories) == 0:
                 abort(404)
-        except:
-            abort(422)
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+            payload['categories'] = categories
+        current_questions = paginate_questions(request, Question.query, fields)
         if len(current_questions) == 0:
             abort(404)
-        return jsonify({
-            'success': True,
+        payload.update({
             'questions': current_questions,
-            'total_questions': len(Question.query.all()),
-            'categories': format_categories(categories),
+            'total_questions': count_questions(),
+            'next_cursor': next_cursor(current_questions),
             'current_category': None
         })
+        return jsonify(payload)
 
 
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
@@ -94,14 +314,15 @@ def create_app(test_config=None):
         try:
             question = Question.query.filter(Question.id == question_id).one_or_none()
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            questions_changed()
+            current_questions = paginate_questions(request, Question.query)
             return jsonify({
                 'status_code': 200,
                 'success': True,
                 'deleted': question_id,
                 'questions': current_questions,
-                'total_questions': len(Question.query.all())
+                'total_questions': count_questions(),
+                'next_cursor': next_cursor(current_questions)
                 }), 200
         except:
             abort(422)
@@ -112,32 +333,37 @@ def create_app(test_config=None):
         data = request.get_json()
         searchTerm = data.get('searchTerm', None)
         if searchTerm:
+            # a search only reads, so it can use a replica
+            read_from_replica()
+            fields = requested_fields(request)
             try:
-                categories = Category.query.all()
-                formatted_categories = format_categories(categories)
-                selection = Question.query.filter(Question.question.contains(data['searchTerm'])).order_by(Question.id).all()
-                current_questions = paginate_questions(request, selection)
+                payload = {'success': True}
+                if 'categories' in fields:
+                    payload['categories'] = format_categories()
+                page = request.args.get('page', 1, type=int)
+                if page < 1:
+                    abort(404)
+                selection, total_questions = search_questions(searchTerm, page, QUESTIONS_PER_PAGE)
+                current_questions = [
+                    {key: value for key, value in format_question(row).items() if key in fields}
+                    for row in selection]
                 if len(current_questions) == 0:
                     abort(404)
-                return jsonify({
-                    'success': True,
+                payload.update({
                     'questions': current_questions,
-                    'total_questions': len(selection),
-                    'categories': formatted_categories
+                    'total_questions': total_questions
                 })
+                return jsonify(payload)
             except:
                 abort(404)
 
         else:
-            if (data.get('question') and data.get('answer') and data.get('category') and data.get('difficulty')):
-                new_question = Question(
-                    question=data.get('question', None),
-                    answer=data.get('answer', None),
-                    category=data.get('category', None),
-                    difficulty=data.get('difficulty', None)
-                    )
+            values, error = validate_question(data, categories=known_categories(data))
+            if error is None:
+                new_question = Question(**values)
                 try:
                     Question.insert(new_question)
+                    questions_changed()
                     return jsonify({
                         'success': True,
                         'status_code': 201,
@@ -149,63 +375,284 @@ def create_app(test_config=None):
                 abort(422)
 
 
-    @app.route('/categories/<int:category_id>/questions', methods=['GET'])
-    def retrieve_questions_by_category_id(category_id):
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_add_questions():
+        if request.mimetype == 'text/csv':
+            rows = csv_rows(request.stream)
+        elif request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            rows = ndjson_rows(request.stream)
+        else:
+            abort(400)
+        inserted = 0
+        errors = []
+        batch = []
+
+        def flush(batch):
+            try:
+                db.session.execute(Question.__table__.insert(), [values for _, values in batch])
+                adjust_question_counts(db.session.connection(), collections.Counter(
+                    values['category'] for _, values in batch))
+                db.session.commit()
+                return len(batch)
+            except:
+                db.session.rollback()
+                errors.extend({'row': row, 'error': 'rejected by the database'} for row, _ in batch)
+                return 0
+
+        # reloaded, so categories added by another worker are known
+        category_cache.invalidate()
+        categories = category_cache.get().categories
+        for row_number, row in enumerate(rows, 1):
+            if not isinstance(row, dict):
+                errors.append({'row': row_number, 'error': row})
+                continue
+            values, error = validate_question(row, categories=categories)
+            if error is not None:
+                errors.append({'row': row_number, 'error': error})
+                continue
+            batch.append((row_number, values))
+            if len(batch) == BULK_BATCH_SIZE:
+                inserted += flush(batch)
+                batch = []
+        if batch:
+            inserted += flush(batch)
+        if inserted:
+            questions_changed()
+            search_index.invalidate()
+        return jsonify({
+            'success': True,
+            'status_code': 201,
+            'inserted': inserted,
+            'errors': errors
+            }), 201
+
+
+    @app.route('/questions/batch', methods=['POST'])
+    def batch_questions():
+        data = request.get_json(silent=True)
+        operations = data.get('operations') if isinstance(data, dict) else None
+        if not isinstance(operations, list) or len(operations) > BATCH_MAX_OPERATIONS:
+            abort(400)
+        category_cache.invalidate()
+        categories = category_cache.get().categories
+        results = [None] * len(operations)
+        creates = []
+        updates = {}
+        deletes = {}
+        for index, operation in enumerate(operations):
+            if not isinstance(operation, dict):
+                results[index] = {'op': None, 'status': 'rejected', 'error': 'not a JSON object'}
+                continue
+            op = operation.get('op')
+            values = operation.get('values')
+            error = None
+            if op == 'create':
+                values, error = validate_question(values if isinstance(values, dict) else {},
+                                                  categories=categories)
+                if error is None:
+                    creates.append((index, values))
+            elif op in ('update', 'delete'):
+                question_id = operation.get('id')
+                if op == 'update':
+                    values, error = validate_question(values if isinstance(values, dict) else {},
+                                                      partial=True, categories=categories)
+                if type(question_id) is not int:
+                    error = 'id must be an integer'
+                elif question_id in updates or question_id in deletes:
+                    error = 'question {} is already changed by this batch'.format(question_id)
+                if error is None and op == 'update':
+                    updates[question_id] = (index, values)
+                elif error is None:
+                    deletes[question_id] = index
+            else:
+                error = 'op must be create, update or delete'
+            results[index] = {'op': op, 'status': 'rejected', 'error': error}
+
         try:
-            category = Category.query.get(category_id)
+            created, updated, deleted = write_questions(
+                db.session.connection(),
+                [values for _, values in creates],
+                {question_id: values for question_id, (_, values) in updates.items()},
+                list(deletes))
+            db.session.commit()
         except:
-            abort(404)
+            db.session.rollback()
+            abort(422)
+
+        for (index, _), question_id in zip(creates, created):
+            results[index] = {'op': 'create', 'status': 'created', 'id': question_id}
+        for question_id, (index, _) in updates.items():
+            results[index] = {'op': 'update', 'id': question_id,
+                              'status': 'updated' if question_id in updated else 'not found'}
+        for question_id, index in deletes.items():
+            results[index] = {'op': 'delete', 'id': question_id,
+                              'status': 'deleted' if question_id in deleted else 'not found'}
+        if created or updated or deleted:
+            questions_changed()
+            search_index.invalidate()
+        return jsonify({
+            'success': True,
+            'status_code': 200,
+            'results': results
+            }), 200
+
+
+    @app.route('/questions/export', methods=['GET'])
+    def export_questions():
+        etag = body_etag(response_cache.key('export').encode())
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        questions = Question.__table__
+        selection = select([
+            questions.c.id,
+            questions.c.question,
+            questions.c.answer,
+            questions.c.category,
+            questions.c.difficulty
+            ]).order_by(questions.c.id)
+
+        def generate():
+            # stream_results makes psycopg2 use a server-side cursor
+            connection = db.session.connection().execution_options(stream_results=True)
+            result = connection.execute(selection)
+            while True:
+                rows = result.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield ''.join(json.dumps(dict(row), sort_keys=True) + '\n' for row in rows)
+
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.set_etag(etag)
+        return response
 
+
+    @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @cached
+    def retrieve_questions_by_category_id(category_id):
+        fields = requested_fields(request)
         try:
-            questions = Question.query.filter(Question.category == category_id).order_by(Question.id).all()
-            selection = Question.query.filter(Question.category == category_id).order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            selection = Question.query.filter(Question.category == category_id)
+            current_questions = paginate_questions(request, selection, fields)
             if len(current_questions) == 0:
                 abort(404)
             return jsonify({
                 'success': True,
                 'questions': current_questions,
-                'total_questions': len(
-                    Question.query.filter(Question.category == category_id).all()
-                    ),
+                'total_questions': count_questions(category_id),
+                'next_cursor': next_cursor(current_questions),
             }), 200
+        except HTTPException:
+            # e.g. 400 for an invalid cursor
+            raise
         except:
             abort(404)
 
 
     @app.route('/quizzes', methods=['POST'])
+    @read_only
     def have_a_quiz():
         try:
             data = request.json
             if not ('previous_questions' in data and 'quiz_category' in data):
                 abort(422)
-            category_id = data['quiz_category']['id']
-            previous_questions = data['previous_questions']
-            if category_id == 0:
-                questions = Question.query.order_by(Question.id).all()
-            else:
-                questions = Question.query.filter(Question.category == category_id).order_by(Question.id).all()
-            i = 0
-            while i < 1:
-                question = random.choice(questions)
-                if question not in previous_questions:
-                    previous_questions.append(question)
-                    i = 1
+            category_id = int(data['quiz_category']['id'])
+            previous_questions = [int(i) for i in data['previous_questions']]
+            question = question_pool.draw(category_id, previous_questions)
+            if question is None:
+                return jsonify({
+                    'status_code': 200,
+                    'success': True,
+                    'question': None,
+                    'quiz_finished': True
+                }), 200
             return jsonify({
                 'status_code': 200,
                 'success': True,
-                'question': {
-                    'id': question.id,
-                    'question': question.question,
-                    'answer': question.answer,
-                    'difficulty': question.difficulty,
-                    'category': question.category
-                    },
+                'question': format_question(question),
             }), 200
         except:
             abort(422)
 
 
+    @app.route('/quizzes/deck', methods=['GET'])
+    def get_quiz_deck():
+        try:
+            category_id = int(request.args.get('category') or 0)
+            difficulty = request.args.get('difficulty')
+            difficulty = int(difficulty) if difficulty else None
+            size = int(request.args.get('size') or DECK_SIZE)
+        except ValueError:
+            abort(400)
+        if not 1 <= size <= DECK_MAX_SIZE:
+            abort(400)
+        questions = [format_question(row)
+                     for row in question_pool.sample(category_id, difficulty, size)]
+        if len(questions) == 0:
+            abort(404)
+        return jsonify({
+            'status_code': 200,
+            'success': True,
+            'questions': questions,
+            'total_questions': len(questions)
+        }), 200
+
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @read_only
+    def create_quiz_session():
+        try:
+            data = request.json
+            category_id = int(data['quiz_category']['id'])
+            question_ids = question_pool.ids(category_id)
+            session_id = quiz_sessions.create(question_ids)
+        except:
+            abort(422)
+        return jsonify({
+            'status_code': 201,
+            'success': True,
+            'session_id': session_id,
+            'total_questions': min(len(question_ids), quiz_sessions.max_questions)
+        }), 201
+
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @read_only
+    def next_quiz_question(session_id):
+        while True:
+            try:
+                question_id, session_id = quiz_sessions.draw(session_id)
+            except KeyError:
+                abort(404)
+            if question_id is None:
+                return jsonify({
+                    'status_code': 200,
+                    'success': True,
+                    'session_id': session_id,
+                    'question': None,
+                    'quiz_finished': True
+                }), 200
+            question = (db.session.query(*QUESTION_COLUMNS)
+                        .filter(Question.id == question_id).first())
+            # skip questions deleted since the session started
+            if question is not None:
+                return jsonify({
+                    'status_code': 200,
+                    'success': True,
+                    'session_id': session_id,
+                    'question': format_question(question),
+                    'quiz_finished': False
+                }), 200
+
+
+    @app.route('/stats/pool', methods=['GET'])
+    def get_pool_stats():
+        return jsonify({
+            'success': True,
+            'pool': pool_status()
+            }), 200
+
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
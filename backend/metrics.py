@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+
+from flask import Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import pool_status
+
+'''
+Request and query instrumentation
+
+init_metrics(app) times every SQL statement through SQLAlchemy engine
+events and every request through before_request/after_request. Each
+response gets a Server-Timing header with the number of statements and
+the time spent in the database and in the whole request. Statements
+slower than SLOW_QUERY_MS (default 100) are logged as warnings. Totals
+per endpoint are served in Prometheus text format at GET /metrics.
+'''
+
+
+class Metrics:
+
+    def __init__(self, slow_query_ms=100):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.endpoints = {}
+
+    def record(self, endpoint, method, status, duration, queries, db_time, slow_queries):
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            totals = self.endpoints.setdefault(endpoint, {
+                'count': 0, 'duration': 0.0, 'queries': 0, 'db_time': 0.0, 'slow_queries': 0
+                })
+            totals['count'] += 1
+            totals['duration'] += duration
+            totals['queries'] += queries
+            totals['db_time'] += db_time
+            totals['slow_queries'] += slow_queries
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, description, samples, suffix=''):
+            if description:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, label_text, value) if label_text
+                             else '{}{} {}'.format(name, suffix, value))
+
+        with self._lock:
+            requests = sorted(self.requests.items())
+            endpoints = sorted((name, dict(totals)) for name, totals in self.endpoints.items())
+        metric('trivia_requests_total', 'counter', 'Requests handled.', [
+            ((('endpoint', endpoint), ('method', method), ('status', status)), count)
+            for (endpoint, method, status), count in requests])
+        metric('trivia_request_duration_seconds', 'summary', 'Time spent handling requests.', [
+            ((('endpoint', endpoint),), totals['duration']) for endpoint, totals in endpoints], '_sum')
+        metric('trivia_request_duration_seconds', 'summary', None, [
+            ((('endpoint', endpoint),), totals['count']) for endpoint, totals in endpoints], '_count')
+        for name, field, kind, description in [
+                ('trivia_db_queries_total', 'queries', 'counter', 'SQL statements executed.'),
+                ('trivia_db_duration_seconds_total', 'db_time', 'counter', 'Time spent in SQL statements.'),
+                ('trivia_db_slow_queries_total', 'slow_queries', 'counter', 'SQL statements slower than SLOW_QUERY_MS.')]:
+            metric(name, kind, description, [
+                ((('endpoint', endpoint),), totals[field]) for endpoint, totals in endpoints])
+        pool = pool_status()
+        for field, kind in [('size', 'gauge'), ('checked_out', 'gauge'), ('overflow', 'gauge'),
+                            ('checkouts', 'counter'), ('timeouts', 'counter'),
+                            ('wait_seconds_total', 'counter'), ('wait_seconds_max', 'gauge')]:
+            if field in pool:
+                metric('trivia_db_pool_' + field, kind, 'Connection pool ' + field.replace('_', ' ') + '.',
+                       [((), pool[field])])
+        return '\n'.join(lines) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+    if context is not None:
+        context.query_timer_started = True
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    # a failed statement never reaches after_cursor_execute, and
+    # conn.info outlives the checkout, so drop its start time here
+    context = exception_context.execution_context
+    if context is not None and getattr(context, 'query_timer_started', False):
+        context.query_timer_started = False
+        exception_context.connection.info['query_started'].pop()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_timer_started = False
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if not has_app_context() or 'db_queries' not in g:
+        return
+    g.db_queries += 1
+    g.db_time += elapsed
+    metrics = current_app.extensions.get('metrics')
+    if metrics is not None and elapsed * 1000 >= metrics.slow_query_ms:
+        g.db_slow_queries += 1
+        current_app.logger.warning('slow query (%.1f ms) in %s: %s',
+                                   elapsed * 1000, request.endpoint, statement)
+
+
+def init_metrics(app):
+    metrics = app.extensions['metrics'] = Metrics(
+        float(app.config.get('SLOW_QUERY_MS', os.environ.get('SLOW_QUERY_MS', 100))))
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.db_queries = 0
+        g.db_time = 0.0
+        g.db_slow_queries = 0
+
+    @app.after_request
+    def add_server_timing(response):
+        if 'request_started' not in g:
+            return response
+        duration = time.perf_counter() - g.request_started
+        response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries", app;dur={:.2f}'.format(
+            g.db_time * 1000, g.db_queries, duration * 1000))
+        metrics.record(request.endpoint or 'unmatched', request.method, response.status_code,
+                       duration, g.db_queries, g.db_time, g.db_slow_queries)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,229 @@
+import os
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, text, Integer
+
+from models import db
+
+'''
+Schema migrations
+
+MIGRATIONS lists every schema change in order. upgrade() applies the
+ones a database hasn't had yet, each in its own transaction, and records
+them in the schema_migrations table. The app never changes the schema
+when it starts; run
+
+    flask db upgrade
+
+after restoring trivia.psql or pulling new migrations, and
+`flask db status` to list what has been applied. New migrations are
+appended to MIGRATIONS and must never be edited once released.
+
+The app checks that the schema is up to date when DB_CHECK_SCHEMA says
+so: on the first request (first-request, the default), while create_app
+runs (startup), or never (off; run `flask db check` from a deploy
+script instead). Until then create_app doesn't connect to the database.
+'''
+
+
+def create_tables(connection):
+    # the schema of trivia.psql
+    tables = inspect(connection).get_table_names()
+    if 'categories' not in tables:
+        connection.execute(text(
+            'CREATE TABLE categories ('
+            ' id {}, type TEXT)'.format(primary_key(connection))
+            ))
+    if 'questions' not in tables:
+        connection.execute(text(
+            'CREATE TABLE questions ('
+            ' id {}, question TEXT, answer TEXT, difficulty INTEGER,'
+            ' category INTEGER REFERENCES categories (id)'
+            ' ON UPDATE CASCADE ON DELETE SET NULL)'.format(primary_key(connection))
+            ))
+
+
+def primary_key(connection):
+    if connection.dialect.name == 'postgresql':
+        return 'SERIAL PRIMARY KEY'
+    return 'INTEGER NOT NULL PRIMARY KEY'
+
+
+def category_foreign_key(connection):
+    # databases made by the old db.create_all() store the category id as
+    # a string, with no foreign key; ids that don't match a category
+    # become NULL
+    inspector = inspect(connection)
+    column = [c for c in inspector.get_columns('questions') if c['name'] == 'category'][0]
+    has_foreign_key = any(fk['referred_table'] == 'categories'
+                          for fk in inspector.get_foreign_keys('questions'))
+    if isinstance(column['type'], Integer) and has_foreign_key:
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            'ALTER TABLE questions ALTER COLUMN category TYPE INTEGER'
+            " USING CASE WHEN category::text ~ '^[0-9]+$' THEN category::text::integer END"
+            ))
+        connection.execute(text(
+            'UPDATE questions SET category = NULL'
+            ' WHERE category NOT IN (SELECT id FROM categories)'
+            ))
+        if not has_foreign_key:
+            connection.execute(text(
+                'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey'
+                ' FOREIGN KEY (category) REFERENCES categories (id)'
+                ' ON UPDATE CASCADE ON DELETE SET NULL'
+                ))
+        return
+    # SQLite can't change a column's type, so the table is rebuilt
+    connection.execute(text(
+        'CREATE TABLE questions_new ('
+        ' id INTEGER NOT NULL PRIMARY KEY, question TEXT, answer TEXT, difficulty INTEGER,'
+        ' category INTEGER REFERENCES categories (id)'
+        ' ON UPDATE CASCADE ON DELETE SET NULL)'
+        ))
+    connection.execute(text(
+        'INSERT INTO questions_new (id, question, answer, difficulty, category)'
+        ' SELECT id, question, answer, difficulty,'
+        ' CASE WHEN CAST(category AS INTEGER) IN (SELECT id FROM categories)'
+        ' THEN CAST(category AS INTEGER) END FROM questions'
+        ))
+    connection.execute(text('DROP TABLE questions'))
+    connection.execute(text('ALTER TABLE questions_new RENAME TO questions'))
+
+
+def question_indexes(connection):
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_difficulty ON questions (difficulty)'))
+
+
+def search_index(connection):
+    # used to search question text with ILIKE and rank the matches by
+    # similarity; other databases search with search.TrigramIndex
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_question_trgm'
+        ' ON questions USING gin (question gin_trgm_ops)'
+        ))
+
+
+def question_counts(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS question_counts ('
+        ' category INTEGER NOT NULL PRIMARY KEY, questions INTEGER NOT NULL DEFAULT 0)'
+        ))
+    connection.execute(text('DELETE FROM question_counts'))
+    connection.execute(text(
+        'INSERT INTO question_counts (category, questions)'
+        ' SELECT COALESCE(category, 0), COUNT(*) FROM questions GROUP BY COALESCE(category, 0)'
+        ))
+
+
+def cache_counters(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS cache_counters ('
+        ' name TEXT NOT NULL PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)'
+        ))
+
+
+MIGRATIONS = [
+    (1, 'create the categories and questions tables', create_tables),
+    (2, 'make questions.category an integer foreign key to categories', category_foreign_key),
+    (3, 'index questions on (category, id) and on difficulty', question_indexes),
+    (4, 'add the pg_trgm index for searching questions', search_index),
+    (5, 'count the questions in each category', question_counts),
+    (6, 'share cache generations between workers', cache_counters),
+]
+
+
+def applied_versions(connection):
+    if 'schema_migrations' not in inspect(connection).get_table_names():
+        return set()
+    return {row[0] for row in connection.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def pending_migrations(engine):
+    with engine.connect() as connection:
+        applied = applied_versions(connection)
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+def upgrade(engine):
+    '''applies the pending migrations and returns them'''
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            ' version INTEGER NOT NULL PRIMARY KEY, description TEXT)'
+            ))
+    pending = pending_migrations(engine)
+    for version, description, migrate in pending:
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(
+                text('INSERT INTO schema_migrations (version, description) VALUES (:version, :description)'),
+                {'version': version, 'description': description})
+    return pending
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def check_schema(engine):
+    '''raises SchemaOutOfDate if migrations are pending'''
+    pending = pending_migrations(engine)
+    if pending:
+        raise SchemaOutOfDate('the database schema is out of date, run `flask db upgrade`: '
+                              + ', '.join(str(version) for version, _, _ in pending))
+
+
+def init_schema_check(app):
+    mode = app.config.get('DB_CHECK_SCHEMA', os.environ.get('DB_CHECK_SCHEMA', 'first-request'))
+    if mode == 'startup':
+        with app.app_context():
+            check_schema(db.engine)
+    elif mode == 'first-request':
+        # Flask keeps calling this until it succeeds, so the app recovers
+        # once the migrations have been applied
+        @app.before_first_request
+        def check_schema_on_first_request():
+            check_schema(db.engine)
+    elif mode != 'off':
+        raise ValueError('DB_CHECK_SCHEMA must be first-request, startup or off')
+
+
+cli = AppGroup('db', help='Manage the database schema.')
+
+
+@cli.command('upgrade')
+def upgrade_command():
+    '''Apply the pending schema migrations.'''
+    applied = upgrade(db.engine)
+    for version, description, _ in applied:
+        click.echo('applied {}: {}'.format(version, description))
+    if not applied:
+        click.echo('the database is up to date')
+
+
+@cli.command('check')
+def check_command():
+    '''Exit with status 1 if migrations are pending.'''
+    try:
+        check_schema(db.engine)
+    except SchemaOutOfDate as error:
+        raise click.ClickException(str(error))
+    click.echo('the database is up to date')
+
+
+@cli.command('status')
+def status_command():
+    '''List the schema migrations and whether they have been applied.'''
+    pending = {migration[0] for migration in pending_migrations(db.engine)}
+    for version, description, _ in MIGRATIONS:
+        click.echo('{} {}: {}'.format('pending' if version in pending else 'applied',
+                                      version, description))
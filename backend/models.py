@@ -1,29 +1,228 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+import collections
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, bindparam, create_engine, event, exc, func, inspect, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+from flask import current_app, g, request
 import json
+import sqlalchemy
+
+from replicas import ReplicaSet, RoutingSQLAlchemy
 
 database_name = "trivia"
 DATABASE_NAME = "trivia"
 username = 'postgres'
 password = '123456'
 url = 'localhost:5432'
-database_path = "postgres://{}:{}@{}/{}".format(username, password, url, DATABASE_NAME)
+database_path = os.environ.get(
+    'DATABASE_URL',
+    "postgresql://{}:{}@{}/{}".format(username, password, url, DATABASE_NAME)
+    )
+
+db = RoutingSQLAlchemy()
 
-db = SQLAlchemy()
+SQLALCHEMY_VERSION = tuple(int(part) for part in sqlalchemy.__version__.split('.')[:2])
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The database is
+    database_path if given, else the app's SQLALCHEMY_DATABASE_URI, else
+    DATABASE_URL from the environment. Reads can be spread over read
+    replicas: replica_paths if given, else DATABASE_REPLICA_URLS from
+    the app config or the environment (comma separated); see
+    replicas.py. It doesn't touch the schema; that is done by
+    `flask db upgrade` (see migrations.py).
 '''
 
 
-def setup_db(app, database_path=database_path):
+def normalize_database_url(database_path):
+    # SQLAlchemy 1.4 no longer accepts the postgres:// scheme that
+    # Heroku and older configs use
+    if database_path.startswith('postgres://'):
+        return 'postgresql://' + database_path[len('postgres://'):]
+    return database_path
+
+
+def setup_db(app, database_path=None, replica_paths=None):
+    database_path = normalize_database_url(database_path
+                                           or app.config.get("SQLALCHEMY_DATABASE_URI")
+                                           or globals()['database_path'])
+    if replica_paths is None:
+        replica_paths = app.config.get('DATABASE_REPLICA_URLS', os.environ.get('DATABASE_REPLICA_URLS', ''))
+    if isinstance(replica_paths, str):
+        replica_paths = [path.strip() for path in replica_paths.split(',') if path.strip()]
+    binds = {'replica_{}'.format(index): normalize_database_url(path)
+             for index, path in enumerate(replica_paths)}
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = binds or None
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    app.extensions.pop('replicas', None)
+    if binds:
+        app.extensions['replicas'] = ReplicaSet(
+            db, app, list(binds),
+            check_interval=db_setting(app, 'DB_REPLICA_CHECK_SECONDS', 5, float),
+            retry_after=db_setting(app, 'DB_REPLICA_RETRY_SECONDS', 30, float),
+            read_after_write=db_setting(app, 'DB_READ_AFTER_WRITE_SECONDS', 5, float))
+        if route_reads not in app.before_request_funcs.get(None, []):
+            app.before_request(route_reads)
+            app.after_request(remember_writes)
+
+
+def route_reads():
+    if 'replicas' not in current_app.extensions:
+        return
+    view = current_app.view_functions.get(request.endpoint)
+    read_from_replica(request.method in ('GET', 'HEAD') or getattr(view, 'read_only', False))
+
+
+def read_from_replica(read_only=True):
+    '''
+    sends the rest of this request's reads to a replica if it only
+    reads and its client hasn't written recently
+    '''
+    replicas = current_app.extensions.get('replicas')
+    db.session().use_replica = bool(read_only and replicas is not None
+                                    and not replicas.client_wrote_recently(request))
+
+
+def remember_writes(response):
+    replicas = current_app.extensions.get('replicas')
+    if replicas is not None and g.get('wrote_to_primary'):
+        replicas.remember_write(response)
+    return response
+
+'''
+Engine and pool settings. Each is read from the app config, then from
+the environment:
+
+    DB_POOL_SIZE          connections the pool keeps open (default 5)
+    DB_MAX_OVERFLOW       extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT       seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE       seconds before a connection is replaced (default never)
+    DB_POOL_PRE_PING      test connections before handing them out
+    DB_STATEMENT_TIMEOUT  milliseconds before Postgres cancels a statement
+    DB_PGBOUNCER          no client-side pool and no server-side prepared
+                          statements, for running behind PgBouncer
+
+Replicas get the same settings. With replicas configured:
+
+    DB_REPLICA_CHECK_SECONDS     how often a replica in use is checked (default 5)
+    DB_REPLICA_RETRY_SECONDS     how long a failed replica is skipped (default 30)
+    DB_READ_AFTER_WRITE_SECONDS  how long a client's reads stay on the
+                                 primary after it wrote (default 5)
+'''
+
+
+def db_setting(app, name, default=None, type=int):
+    value = app.config.get(name, os.environ.get(name))
+    if value is None or value == '':
+        return default
+    if type is bool:
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    return type(value)
+
+
+def engine_options(app, database_path):
+    drivername = make_url(database_path).drivername
+    if drivername.startswith('sqlite'):
+        return {}
+    options = {}
+    connect_args = {}
+    if db_setting(app, 'DB_PGBOUNCER', False, bool):
+        # PgBouncer does the pooling, and in transaction mode a prepared
+        # statement may not exist on the server connection we get next.
+        # It also rejects the startup options used for statement_timeout,
+        # so set that on the database role instead.
+        options['poolclass'] = NullPool
+        if drivername.endswith('+asyncpg'):
+            connect_args['statement_cache_size'] = 0
+        elif drivername.endswith('+psycopg'):
+            connect_args['prepare_threshold'] = None
+    else:
+        options['poolclass'] = InstrumentedQueuePool
+        options['pool_size'] = db_setting(app, 'DB_POOL_SIZE', 5)
+        options['max_overflow'] = db_setting(app, 'DB_MAX_OVERFLOW', 10)
+        options['pool_timeout'] = db_setting(app, 'DB_POOL_TIMEOUT', 30)
+        options['pool_recycle'] = db_setting(app, 'DB_POOL_RECYCLE', -1)
+        options['pool_pre_ping'] = db_setting(app, 'DB_POOL_PRE_PING', False, bool)
+        statement_timeout = db_setting(app, 'DB_STATEMENT_TIMEOUT')
+        if statement_timeout and drivername.endswith('+asyncpg'):
+            connect_args['server_settings'] = {'statement_timeout': str(statement_timeout)}
+        elif statement_timeout:
+            connect_args['options'] = '-c statement_timeout={}'.format(statement_timeout)
+    if drivername in ('postgresql', 'postgresql+psycopg2'):
+        # send executemany() (bulk imports and batch updates) as batches,
+        # not row by row; SQLAlchemy 1.4 renamed the option
+        if SQLALCHEMY_VERSION >= (1, 4):
+            options['executemany_mode'] = 'values_plus_batch'
+        else:
+            options['use_batch_mode'] = True
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+'''
+InstrumentedQueuePool
+    QueuePool that records how many connections were checked out, how
+    long callers waited for one and how often they gave up
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+'''
+pool_status()
+    current size and usage of the connection pool
+'''
+
+
+def pool_status():
+    pool = db.engine.pool
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+            })
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update({
+            'checkouts': pool.checkouts,
+            'timeouts': pool.timeouts,
+            'wait_seconds_total': pool.wait_time,
+            'wait_seconds_max': pool.max_wait_time
+            })
+    return status
 
 '''
 Question
@@ -33,11 +232,15 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -66,6 +269,25 @@ class Question(db.Model):
           'difficulty': self.difficulty
         }
 
+'''
+QUESTION_COLUMNS, format_question(row)
+    read-only endpoints select these columns as plain rows instead of
+    loading Question instances; format_question(row) gives the same dict
+    as Question.format()
+'''
+
+QUESTION_COLUMNS = (
+    Question.id,
+    Question.question,
+    Question.answer,
+    Question.category,
+    Question.difficulty
+)
+
+
+def format_question(row):
+    return row._asdict()
+
 '''
 Category
 
@@ -86,3 +308,195 @@ class Category(db.Model):
           'id': self.id,
           'type': self.type
         }
+
+'''
+QuestionCount
+    number of questions in each category, so listings don't count rows.
+    The Question and Category mapper events below keep it up to date in
+    the same transaction as the insert, update or delete; Core inserts
+    (the bulk import) call adjust_question_counts() themselves, and
+    anything else that changes questions or categories outside the ORM
+    calls recount_questions(). Questions without a category are counted
+    under 0.
+'''
+
+
+class QuestionCount(db.Model):
+    __tablename__ = 'question_counts'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    questions = Column(Integer, nullable=False, default=0)
+
+
+def adjust_question_counts(connection, deltas):
+    '''adds deltas, a mapping of category id to change, to the counts'''
+    counts = QuestionCount.__table__
+    changes = collections.Counter()
+    for category, delta in deltas.items():
+        changes[category or 0] += delta
+    for category, delta in sorted(changes.items()):
+        if not delta:
+            continue
+        if connection.dialect.name == 'postgresql':
+            # two transactions adding a category's first question both
+            # insert its row; ON CONFLICT makes the second one add to it
+            statement = postgresql.insert(counts).values(category=category, questions=delta)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[counts.c.category],
+                set_={'questions': counts.c.questions + delta}))
+            continue
+        # elsewhere (SQLite) the UPDATE locks the database until commit,
+        # so no other writer can insert the row in between
+        result = connection.execute(
+            counts.update()
+            .where(counts.c.category == category)
+            .values(questions=counts.c.questions + delta))
+        if result.rowcount == 0:
+            connection.execute(counts.insert().values(category=category, questions=delta))
+
+
+def recount_questions(connection, categories=None):
+    '''rebuilds the counts (of only the given categories) from the questions table'''
+    counts = QuestionCount.__table__
+    category = func.coalesce(Question.__table__.c.category, 0)
+    selection = select([category, func.count()]).group_by(category)
+    delete = counts.delete()
+    if categories is not None:
+        categories = sorted({category_id or 0 for category_id in categories})
+        selection = selection.where(category.in_(categories))
+        delete = delete.where(counts.c.category.in_(categories))
+    connection.execute(delete)
+    connection.execute(counts.insert().from_select(['category', 'questions'], selection))
+
+
+@event.listens_for(Question, 'after_insert')
+def count_inserted_question(mapper, connection, target):
+    adjust_question_counts(connection, {target.category: 1})
+
+
+@event.listens_for(Question, 'after_update')
+def count_updated_question(mapper, connection, target):
+    history = inspect(target).attrs.category.history
+    if history.added:
+        old = history.deleted[0] if history.deleted else None
+        adjust_question_counts(connection, {old: -1, history.added[0]: 1})
+
+
+@event.listens_for(Question, 'after_delete')
+def count_deleted_question(mapper, connection, target):
+    adjust_question_counts(connection, {target.category: -1})
+
+
+@event.listens_for(Category, 'after_delete')
+def count_deleted_category(mapper, connection, target):
+    # the foreign key moves the category's questions to NULL (0)
+    recount_questions(connection, [target.id, 0])
+
+
+@event.listens_for(Category, 'after_update')
+def count_renumbered_category(mapper, connection, target):
+    # and moves them along when its id changes
+    history = inspect(target).attrs.id.history
+    if history.deleted:
+        recount_questions(connection, [history.deleted[0], target.id])
+
+'''
+CacheCounter
+    named counters every worker shares, such as the response cache
+    generation when the cache itself is kept in each process (see
+    cache.DatabaseCounters)
+'''
+
+
+class CacheCounter(db.Model):
+    __tablename__ = 'cache_counters'
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+'''
+write_questions(connection, creates, updates, deletes)
+    applies a batch of changes with bulk statements: one INSERT for the
+    creates, one UPDATE per set of changed columns and one DELETE.
+    creates is a list of column values, updates maps ids to the column
+    values to change and deletes is a list of ids. Keeps question_counts
+    in step, locking the updated and deleted rows; the search index has
+    to be invalidated by the caller.
+    Returns the new ids, and the ids that were updated and deleted
+    (those that didn't exist are left out).
+'''
+
+
+def write_questions(connection, creates, updates, deletes):
+    questions = Question.__table__
+    deltas = collections.Counter()
+    existing = {}
+    if updates or deletes:
+        # lock the rows (in id order, so two batches can't deadlock) until
+        # commit; otherwise another transaction could delete or
+        # re-categorise them before our UPDATE and DELETE, and the count
+        # deltas below would be wrong. SQLite, which only the tests use,
+        # ignores FOR UPDATE.
+        existing = dict(connection.execute(
+            select([questions.c.id, questions.c.category])
+            .where(questions.c.id.in_(list(updates) + list(deletes)))
+            .order_by(questions.c.id)
+            .with_for_update()).fetchall())
+
+    created = []
+    if creates and connection.dialect.name == 'postgresql':
+        result = connection.execute(questions.insert().values(creates).returning(questions.c.id))
+        created = [row[0] for row in result]
+    elif creates:
+        # without RETURNING the ids only come back one row at a time
+        created = [connection.execute(questions.insert(), values).inserted_primary_key[0]
+                   for values in creates]
+    for values in creates:
+        deltas[values['category']] += 1
+
+    updated = [question_id for question_id in updates if question_id in existing]
+    groups = {}
+    for question_id in updated:
+        values = updates[question_id]
+        groups.setdefault(tuple(sorted(values)), []).append(dict(values, _id=question_id))
+        if 'category' in values:
+            deltas[existing[question_id]] -= 1
+            deltas[values['category']] += 1
+    for rows in groups.values():
+        connection.execute(questions.update().where(questions.c.id == bindparam('_id')), rows)
+
+    deleted = [question_id for question_id in deletes if question_id in existing]
+    if deleted:
+        connection.execute(questions.delete().where(questions.c.id.in_(deleted)))
+        for question_id in deleted:
+            deltas[existing[question_id]] -= 1
+
+    adjust_question_counts(connection, deltas)
+    return created, updated, deleted
+
+'''
+question_count_query(category_id=None), categories_with_counts_query()
+    Core selects shared with the ASGI app: the number of questions (in
+    one category or in all of them), and every category with its count
+'''
+
+
+def question_count_query(category_id=None):
+    counts = QuestionCount.__table__
+    selection = select([func.coalesce(func.sum(counts.c.questions), 0)])
+    if category_id is not None:
+        selection = selection.where(counts.c.category == category_id)
+    return selection
+
+
+def categories_with_counts_query():
+    categories = Category.__table__
+    counts = QuestionCount.__table__
+    return (select([categories.c.id, categories.c.type,
+                    func.coalesce(counts.c.questions, 0).label('questions')])
+            .select_from(categories.outerjoin(counts, counts.c.category == categories.c.id))
+            .order_by(categories.c.type))
+
+
+def count_questions(category_id=None):
+    return db.session.execute(question_count_query(category_id)).scalar()
@@ -0,0 +1,100 @@
+import random
+import threading
+import time
+
+from models import db, Question, QUESTION_COLUMNS
+
+'''
+QuestionPool
+    keeps the ids of the questions of every category, and of every
+    category and difficulty, in memory, so a quiz draw only has to load
+    the one question it picked and a deck only the questions it sampled.
+    Each app keeps its own in app.extensions['question_pool']. Writes
+    through the API call invalidate(); the TTL covers writes made by
+    other workers. Ids loaded from a replica, which may lag behind a
+    write, are kept only for replica_ttl seconds and aren't used by
+    requests that read from the primary.
+'''
+
+
+class QuestionPool:
+
+    def __init__(self, ttl=60, replica_ttl=5):
+        self.ttl = ttl
+        self.replica_ttl = replica_ttl
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def ids(self, category_id, difficulty=None):
+        '''ids of the category's questions (all categories for 0 or None)'''
+        key = (category_id or 0, difficulty)
+        now = time.monotonic()
+        session = db.session()
+        with self._lock:
+            entry = self._ids.get(key)
+        if entry is not None:
+            loaded_at, ids, from_replica = entry
+            if from_replica:
+                if session.use_replica and now - loaded_at < self.replica_ttl:
+                    return ids
+            elif now - loaded_at < self.ttl:
+                return ids
+        query = db.session.query(Question.id)
+        if category_id:
+            query = query.filter(Question.category == category_id)
+        if difficulty is not None:
+            query = query.filter(Question.difficulty == difficulty)
+        ids = tuple(row[0] for row in query.order_by(Question.id))
+        with self._lock:
+            self._ids[key] = (now, ids, session.used_replica)
+        return ids
+
+    def draw(self, category_id, previous_ids):
+        '''
+        returns a random question (a QUESTION_COLUMNS row) of the category
+        that is not in previous_ids, or None once the category is exhausted
+        '''
+        previous_ids = set(previous_ids)
+        while True:
+            ids = self.ids(category_id)
+            if len(previous_ids) * 2 < len(ids):
+                # mostly unused: pick random positions until one is new,
+                # which takes fewer than two tries on average
+                question_id = ids[random.randrange(len(ids))]
+                if question_id in previous_ids:
+                    continue
+            else:
+                remaining = [i for i in ids if i not in previous_ids]
+                if not remaining:
+                    return None
+                question_id = random.choice(remaining)
+            question = (db.session.query(*QUESTION_COLUMNS)
+                        .filter(Question.id == question_id).first())
+            if question is not None:
+                return question
+            # deleted by another worker since the pool was loaded
+            previous_ids.add(question_id)
+            self.invalidate()
+
+    def sample(self, category_id, difficulty, size):
+        '''
+        returns up to size questions (QUESTION_COLUMNS rows) of the
+        category and difficulty, a uniform random sample without
+        replacement, loaded with one query
+        '''
+        for _ in range(2):
+            ids = self.ids(category_id, difficulty)
+            sample = random.sample(ids, min(size, len(ids)))
+            rows = (db.session.query(*QUESTION_COLUMNS)
+                    .filter(Question.id.in_(sample)).all()) if sample else []
+            if len(rows) == len(sample):
+                break
+            # some were deleted by another worker since the pool was loaded
+            self.invalidate()
+        order = {question_id: index for index, question_id in enumerate(sample)}
+        return sorted(rows, key=lambda row: order[row.id])
+
+    def invalidate(self):
+        with self._lock:
+            self._ids.clear()
+
@@ -0,0 +1,136 @@
+import array
+import collections
+import os
+import random
+import secrets
+import threading
+import time
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+'''
+Quiz sessions
+
+POST /quizzes/sessions shuffles the ids of the questions a quiz can ask
+once (keeping at most max_questions of them), and
+POST /quizzes/sessions/<session_id>/next hands them out in that order,
+so the client doesn't send back the questions it has seen.
+A store creates sessions and draws their next question id:
+
+MemorySessionStore
+    keeps each session as an array of ids and a position in this
+    process. Sessions expire after ttl seconds and the oldest are dropped
+    beyond maxsize, so memory stays bounded. With several workers the
+    client has to stick to one of them.
+
+TokenSessionStore
+    keeps nothing on the server: the session id is a signed token
+    holding the ids still to ask, and every draw returns a new token.
+    Any worker can serve it, but a draw isn't constant time: it decodes
+    and re-signs the remaining ids, and the token (sent in the URL)
+    grows with them, about 2.8 KB for 1000 questions. Lower
+    max_questions to bound both.
+'''
+
+
+class MemorySessionStore:
+
+    def __init__(self, ttl=3600, maxsize=10000, max_questions=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_questions = max_questions
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, question_ids):
+        session_id = secrets.token_urlsafe(16)
+        # 8 bytes per question instead of a list of int objects
+        question_ids = array.array('q', shuffled(question_ids, self.max_questions))
+        session = [question_ids, 0, time.monotonic()]
+        with self._lock:
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+        return session_id
+
+    def draw(self, session_id):
+        '''
+        returns (question_id, session_id); question_id is None once the
+        session has run out of questions. Raises KeyError for unknown or
+        expired sessions.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions[session_id]
+            question_ids, position, _ = session
+            if position == len(question_ids):
+                return None, session_id
+            session[1] = position + 1
+            return question_ids[position], session_id
+
+    def _expire(self, now):
+        # sessions are kept in creation order, so expired ones are first
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session[2] < self.ttl:
+                break
+            del self._sessions[session_id]
+
+
+class TokenSessionStore:
+
+    def __init__(self, secret_key, ttl=3600, max_questions=1000):
+        self.ttl = ttl
+        self.max_questions = max_questions
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='quiz-session')
+
+    def create(self, question_ids):
+        return self.serializer.dumps({
+            'ids': shuffled(question_ids, self.max_questions),
+            'created': time.time()
+            })
+
+    def draw(self, session_id):
+        try:
+            session = self.serializer.loads(session_id)
+        except BadSignature:
+            raise KeyError(session_id)
+        # a redrawn token is newer than its session, so check the session's age
+        if time.time() - session['created'] > self.ttl:
+            raise KeyError(session_id)
+        question_ids = session['ids']
+        if not question_ids:
+            return None, session_id
+        return question_ids[0], self.serializer.dumps(
+            {'ids': question_ids[1:], 'created': session['created']})
+
+
+def quiz_session_store(config):
+    '''
+    QUIZ_SESSION_STORE          memory (default) or token
+    QUIZ_SESSION_TTL            seconds a session lasts (default 3600)
+    QUIZ_SESSION_LIMIT          sessions a memory store keeps (default 10000)
+    QUIZ_SESSION_MAX_QUESTIONS  questions one session can ask (default 1000)
+    SECRET_KEY                  signs the token store's sessions
+    '''
+    def setting(name, default):
+        return config.get(name, os.environ.get(name, default))
+    ttl = int(setting('QUIZ_SESSION_TTL', 3600))
+    max_questions = int(setting('QUIZ_SESSION_MAX_QUESTIONS', 1000))
+    if setting('QUIZ_SESSION_STORE', 'memory') == 'token':
+        # Flask's config always has a SECRET_KEY, None unless it was set
+        secret_key = config.get('SECRET_KEY') or os.environ.get('SECRET_KEY')
+        if not secret_key:
+            raise RuntimeError('QUIZ_SESSION_STORE=token needs a SECRET_KEY')
+        return TokenSessionStore(secret_key, ttl, max_questions)
+    return MemorySessionStore(ttl, int(setting('QUIZ_SESSION_LIMIT', 10000)), max_questions)
+
+
+def shuffled(question_ids, limit):
+    '''a random order of question_ids, at most limit of them'''
+    if len(question_ids) > limit:
+        return random.sample(question_ids, limit)
+    question_ids = list(question_ids)
+    random.shuffle(question_ids)
+    return question_ids
@@ -0,0 +1,135 @@
+import itertools
+import logging
+import math
+import time
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.orm import sessionmaker
+
+'''
+Read replicas
+
+setup_db() registers every replica URI as a Flask-SQLAlchemy bind named
+replica_0, replica_1, ... and a ReplicaSet in app.extensions['replicas'].
+RoutingSession sends the reads of read-only requests (GET and HEAD, and
+views marked with @read_only) to one replica per request, chosen round
+robin. Everything else goes to the primary:
+
+- flushes and INSERT/UPDATE/DELETE statements
+- every later read of a request that wrote to the primary
+- every read of a client for DB_READ_AFTER_WRITE_SECONDS after it
+  wrote, so it never reads a replica that hasn't caught up with its
+  own write. A request that writes sets the READ_AFTER_WRITE_COOKIE
+  cookie to the time until which that client reads from the primary,
+  so this holds whichever worker serves its next request, and other
+  clients keep using the replicas.
+- reads while no replica is healthy
+
+A replica is checked with SELECT 1 when it is picked and its last check
+is older than DB_REPLICA_CHECK_SECONDS. One that fails is skipped for
+DB_REPLICA_RETRY_SECONDS.
+'''
+
+logger = logging.getLogger(__name__)
+
+READ_AFTER_WRITE_COOKIE = 'trivia_primary_until'
+
+
+class ReplicaSet:
+
+    def __init__(self, db, app, bind_keys, check_interval=5, retry_after=30, read_after_write=5):
+        self.db = db
+        self.app = app
+        self.bind_keys = list(bind_keys)
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self.read_after_write = read_after_write
+        self._checked_at = dict.fromkeys(self.bind_keys, None)
+        self._down_until = dict.fromkeys(self.bind_keys, 0.0)
+        self._next = itertools.count()
+
+    def engine(self, bind_key):
+        return self.db.get_engine(self.app, bind=bind_key)
+
+    def choose(self):
+        '''returns the engine of the next healthy replica, or None'''
+        now = time.monotonic()
+        for _ in self.bind_keys:
+            bind_key = self.bind_keys[next(self._next) % len(self.bind_keys)]
+            if self.healthy(bind_key, now):
+                return self.engine(bind_key)
+        return None
+
+    def healthy(self, bind_key, now):
+        if now < self._down_until[bind_key]:
+            return False
+        checked_at = self._checked_at[bind_key]
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return True
+        try:
+            with self.engine(bind_key).connect() as connection:
+                connection.execute(select([1]))
+        except exc.DBAPIError as error:
+            logger.warning('replica %s is unavailable for %s s: %s', bind_key, self.retry_after, error)
+            self._down_until[bind_key] = now + self.retry_after
+            return False
+        self._checked_at[bind_key] = now
+        return True
+
+    def client_wrote_recently(self, request):
+        try:
+            return float(request.cookies.get(READ_AFTER_WRITE_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def remember_write(self, response):
+        response.set_cookie(
+            READ_AFTER_WRITE_COOKIE, '{:.3f}'.format(time.time() + self.read_after_write),
+            max_age=math.ceil(self.read_after_write), httponly=True)
+
+
+class RoutingSession(SignallingSession):
+
+    # set for each request by setup_db's before_request hook
+    use_replica = False
+    _replica = None
+
+    @property
+    def used_replica(self):
+        '''whether this session has read from a replica'''
+        return bool(self._replica)
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get('replicas')
+        if (self.use_replica and replicas is not None and not self._flushing
+                and not isinstance(clause, UpdateBase) and not g.get('wrote_to_primary')):
+            if self._replica is None:
+                # one replica per session, so a request reads one snapshot
+                self._replica = replicas.choose() or False
+            if self._replica:
+                return self._replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(view):
+    '''marks a view that never writes, so its reads can go to a replica'''
+    view.read_only = True
+    return view
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_write(conn, cursor, statement, parameters, context, executemany):
+    if context is None or not (context.isinsert or context.isupdate or context.isdelete):
+        return
+    if has_app_context() and 'replicas' in current_app.extensions:
+        g.wrote_to_primary = True
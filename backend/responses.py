@@ -0,0 +1,126 @@
+import hashlib
+import importlib.util
+import os
+import zlib
+
+from flask import Response, request
+from werkzeug.http import remove_entity_headers
+
+# brotli is optional and only imported once a response is compressed with it
+HAS_BROTLI = importlib.util.find_spec('brotli') is not None
+
+'''
+Compression and conditional requests
+
+init_responses(app) adds an after_request hook that gives every
+successful GET a strong ETag (a hash of the body unless the view set one,
+e.g. from the response cache generation) and answers a matching
+If-None-Match with an empty 304. Bodies of at least COMPRESS_MIN_SIZE
+bytes (default 1024), and streamed exports, are then compressed with
+brotli (if installed) or gzip at COMPRESS_LEVEL (default 5), depending
+on the client's Accept-Encoding. A compressed body gets its own ETag,
+the plain one with "-br" or "-gzip" appended; etag_matches() accepts
+either.
+'''
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+
+class Compression:
+
+    def __init__(self, min_size=1024, level=5):
+        self.min_size = min_size
+        self.level = level
+        self.encodings = ['br', 'gzip'] if HAS_BROTLI else ['gzip']
+
+    def encoding(self, accept_encodings):
+        '''the client's preferred encoding of ours (a werkzeug Accept), or None'''
+        return accept_encodings.best_match(self.encodings)
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            import brotli
+            compressor = brotli.Compressor(quality=self.level)
+            return compressor.process, compressor.finish
+        # wbits=31 writes a gzip header without a timestamp, so the same
+        # body always compresses to the same bytes
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+
+    def compress(self, body, encoding):
+        compress, finish = self.compressor(encoding)
+        return compress(body) + finish()
+
+    def compress_chunks(self, chunks, encoding):
+        compress, finish = self.compressor(encoding)
+        for chunk in chunks:
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+
+
+def encoded_etag(etag, encoding):
+    return etag if encoding is None else '{}-{}'.format(etag, encoding)
+
+
+def etag_matches(etag, if_none_match):
+    '''whether a werkzeug ETags (If-None-Match) names etag in any encoding'''
+    if if_none_match.star_tag:
+        return True
+    return any(if_none_match.contains(encoded_etag(etag, encoding))
+               for encoding in (None, 'br', 'gzip'))
+
+
+def not_modified(etag):
+    '''a 304 response if the request's If-None-Match matches etag, else None'''
+    if not etag_matches(etag, request.if_none_match):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def body_etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def init_responses(app):
+    def setting(name, default):
+        return int(app.config.get(name, os.environ.get(name, default)))
+    compression = app.extensions['compression'] = Compression(
+        setting('COMPRESS_MIN_SIZE', 1024), setting('COMPRESS_LEVEL', 5))
+
+    @app.after_request
+    def compress_and_validate(response):
+        if response.status_code != 200 or response.direct_passthrough:
+            return response
+        etag, _ = response.get_etag()
+        if request.method in ('GET', 'HEAD'):
+            if etag is None and not response.is_streamed:
+                etag = body_etag(response.get_data())
+                response.set_etag(etag)
+            if etag is not None and etag_matches(etag, request.if_none_match):
+                response.status_code = 304
+                response.response = []
+                remove_entity_headers(response.headers)
+                return response
+        if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = compression.encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compression.compress_chunks(response.iter_encoded(), encoding)
+        elif response.content_length is not None and response.content_length >= compression.min_size:
+            response.set_data(compression.compress(response.get_data(), encoding))
+        else:
+            return response
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.set_etag(encoded_etag(etag, encoding))
+        return response
+
+    return compression
@@ -0,0 +1,178 @@
+import re
+import threading
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from models import db, Question, QUESTION_COLUMNS
+
+'''
+Question search
+
+Case-insensitive substring search over the question text, ranked by
+trigram similarity to the search term (best match first, then by id).
+On PostgreSQL both the match and the ranking run in SQL against the
+pg_trgm GIN index created by migration 4 (`flask db upgrade`, see
+migrations.py). Other backends, i.e. SQLite in test runs, use
+TrigramIndex below, which applies the same rules in process so both
+return the same results.
+'''
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def word_trigrams(text):
+    '''
+    the trigrams pg_trgm's similarity() compares: every alphanumeric word,
+    lowercased and padded with two spaces in front and one behind
+    '''
+    trigrams = set()
+    for word in re.findall(r'[^\W_]+', text.lower()):
+        word = '  ' + word + ' '
+        trigrams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return trigrams
+
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+'''
+TrigramIndex
+    inverted index from the raw trigrams of each lowercased question to
+    the question ids, used to narrow substring matches the way a pg_trgm
+    index narrows ILIKE '%term%'. Each app keeps its own in
+    app.extensions['search_index']; the Question mapper events below keep
+    the current app's index up to date.
+'''
+
+
+class TrigramIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = None
+        self._documents = None
+
+    def _build(self):
+        postings = {}
+        documents = {}
+        for question_id, text in db.session.query(Question.id, Question.question):
+            self._add(postings, documents, question_id, text)
+        self._postings = postings
+        self._documents = documents
+
+    @staticmethod
+    def _add(postings, documents, question_id, text):
+        text = (text or '').lower()
+        documents[question_id] = (text, word_trigrams(text))
+        for i in range(len(text) - 2):
+            postings.setdefault(text[i:i + 3], set()).add(question_id)
+
+    def _remove(self, question_id):
+        text, _ = self._documents.pop(question_id, ('', None))
+        for i in range(len(text) - 2):
+            ids = self._postings.get(text[i:i + 3])
+            if ids is not None:
+                ids.discard(question_id)
+
+    def add(self, question_id, text):
+        with self._lock:
+            if self._postings is not None:
+                self._remove(question_id)
+                self._add(self._postings, self._documents, question_id, text)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._postings is not None:
+                self._remove(question_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._postings = None
+            self._documents = None
+
+    def search(self, term, offset, limit):
+        '''
+        returns one page of matching question ids, ranked, and the total
+        number of matches
+        '''
+        term = term.lower()
+        with self._lock:
+            if self._postings is None:
+                self._build()
+            if len(term) < 3:
+                candidates = self._documents.keys()
+            else:
+                candidates = None
+                for i in range(len(term) - 2):
+                    ids = self._postings.get(term[i:i + 3], set())
+                    candidates = ids if candidates is None else candidates & ids
+            term_trigrams = word_trigrams(term)
+            matches = []
+            for question_id in candidates:
+                text, trigrams = self._documents[question_id]
+                if term in text:
+                    matches.append((-similarity(trigrams, term_trigrams), question_id))
+        matches.sort()
+        return [question_id for _, question_id in matches[offset:offset + limit]], len(matches)
+
+
+def app_search_index():
+    return current_app.extensions.get('search_index') if has_app_context() else None
+
+
+@event.listens_for(Question, 'after_insert')
+@event.listens_for(Question, 'after_update')
+def index_question(mapper, connection, target):
+    search_index = app_search_index()
+    if search_index is not None:
+        search_index.add(target.id, target.question)
+
+
+@event.listens_for(Question, 'after_delete')
+def unindex_question(mapper, connection, target):
+    search_index = app_search_index()
+    if search_index is not None:
+        search_index.remove(target.id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def reset_index(session):
+    # flushed changes that never got committed may already be indexed
+    search_index = app_search_index()
+    if search_index is not None:
+        search_index.invalidate()
+
+
+def search_filter(term):
+    return Question.question.ilike('%' + escape_like(term) + '%', escape='\\')
+
+
+def search_rank(term):
+    return func.similarity(Question.question, term)
+
+
+def search_questions(term, page, per_page):
+    '''
+    returns the rows (QUESTION_COLUMNS) on the given page of results for
+    term and the total number of matching questions
+    '''
+    offset = (page - 1) * per_page
+    if db.engine.dialect.name == 'postgresql':
+        selection = Question.query.filter(search_filter(term))
+        total = selection.with_entities(func.count(Question.id)).scalar()
+        questions = (selection.with_entities(*QUESTION_COLUMNS)
+                     .order_by(search_rank(term).desc(), Question.id)
+                     .offset(offset).limit(per_page).all())
+        return questions, total
+    ids, total = current_app.extensions['search_index'].search(term, offset, per_page)
+    if not ids:
+        return [], total
+    rows = {row.id: row for row in db.session.query(*QUESTION_COLUMNS).filter(Question.id.in_(ids))}
+    return [rows[i] for i in ids if i in rows], total
@@ -0,0 +1,52 @@
+from flask import current_app, jsonify as flask_jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+jsonify(*args, **kwargs)
+    drop-in replacement for flask.jsonify that skips Flask's per-call
+    encoder setup. With orjson installed and JSON_AS_ASCII off it encodes
+    with orjson; otherwise it reuses one C-accelerated stdlib encoder per
+    configuration. Either way the bytes match flask.jsonify's compact
+    output for the same config, apart from the order of integer keys
+    under orjson. Pretty-printed output (debug mode) still goes through
+    flask.jsonify.
+'''
+
+_encoders = {}
+
+
+def dumps(payload):
+    config = current_app.config
+    if orjson is not None and not config['JSON_AS_ASCII']:
+        option = orjson.OPT_NON_STR_KEYS
+        if config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(payload, option=option) + b'\n'
+    key = (current_app.json_encoder, config['JSON_AS_ASCII'], config['JSON_SORT_KEYS'])
+    encoder = _encoders.get(key)
+    if encoder is None:
+        encoder = _encoders[key] = current_app.json_encoder(
+            ensure_ascii=config['JSON_AS_ASCII'],
+            sort_keys=config['JSON_SORT_KEYS'],
+            separators=(',', ':')
+            )
+    return encoder.encode(payload).encode('utf-8') + b'\n'
+
+
+def jsonify(*args, **kwargs):
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+        return flask_jsonify(*args, **kwargs)
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        payload = args[0]
+    else:
+        payload = args or kwargs
+    return current_app.response_class(
+        dumps(payload),
+        mimetype=current_app.config['JSONIFY_MIMETYPE']
+        )
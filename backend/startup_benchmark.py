@@ -0,0 +1,138 @@
+'''
+Cold-start benchmark for the trivia API.
+
+Measures what a new worker pays before it serves traffic: starting the
+interpreter, importing flaskr, running create_app() and answering the
+first request (which connects to the database and checks the schema).
+Each run is a fresh Python process. It also times create_app() alone, as
+FlaskrTestCase.setUp calls it, to track test-suite setup time:
+
+    python startup_benchmark.py --runs 20 --output startup.json
+    ... change something ...
+    python startup_benchmark.py --runs 20 --compare startup.json
+
+--compare exits with status 1 when a median got worse by more than
+--tolerance. The default database is a new SQLite file; pass
+--database-url to use a local Postgres.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import percentile, seed
+
+CHILD = '''
+import json, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get('/categories')
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000
+}))
+'''
+
+
+def worker_boot(database_url, runs):
+    '''times fresh processes importing the app and serving one request'''
+    env = dict(os.environ, DATABASE_URL=database_url)
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.check_output(
+            [sys.executable, '-c', CHILD], env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        sample = json.loads(output.decode().splitlines()[-1])
+        sample['process_ms'] = (time.perf_counter() - started) * 1000
+        samples.append(sample)
+    return samples
+
+
+def test_setup(database_url, runs):
+    '''times create_app() as each test's setUp runs it'''
+    from flaskr import create_app
+    config = {'SQLALCHEMY_DATABASE_URI': database_url, 'DB_CHECK_SCHEMA': 'off'}
+    create_app(config)
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        create_app(config)
+        samples.append({'create_app_ms': (time.perf_counter() - started) * 1000})
+    return samples
+
+
+def summarize(samples):
+    report = {}
+    for name in samples[0]:
+        values = [sample[name] for sample in samples]
+        report[name] = {
+            'p50_ms': percentile(values, 0.50),
+            'p95_ms': percentile(values, 0.95)
+        }
+    return report
+
+
+def compare(results, baseline, tolerance):
+    '''returns a list of regressions of results against baseline'''
+    regressions = []
+    for group, metrics in results.items():
+        for name, current in metrics.items():
+            previous = baseline.get(group, {}).get(name)
+            if previous is not None and current['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+                regressions.append('{} {} p50 {:.1f} ms > baseline {:.1f} ms'.format(
+                    group, name, current['p50_ms'], previous['p50_ms']))
+    return regressions
+
+
+def print_report(results):
+    print('{:<32} {:>9} {:>9}'.format('', 'p50 ms', 'p95 ms'))
+    for group, metrics in results.items():
+        for name, row in metrics.items():
+            print('{:<32} {:>9.1f} {:>9.1f}'.format(group + ' ' + name, row['p50_ms'], row['p95_ms']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url', help='database to start against (default: a new SQLite file)')
+    parser.add_argument('--runs', type=int, default=10, help='worker boots to time')
+    parser.add_argument('--setup-runs', type=int, default=100, help='test setups to time')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown before --compare fails (default 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')
+        from flaskr import create_app
+        seed(create_app({'SQLALCHEMY_DATABASE_URI': database_url, 'DB_CHECK_SCHEMA': 'off'}),
+             100, 6, True)
+    results = {
+        'worker_boot': summarize(worker_boot(database_url, args.runs)),
+        'test_setup': summarize(test_setup(database_url, args.setup_runs))
+    }
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())